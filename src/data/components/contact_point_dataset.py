@@ -1,52 +1,238 @@
-from typing import Optional, Tuple
+import json
+import os
+from typing import Iterator, Optional, Tuple, Union
 import torch
 from torch.utils.data import DataLoader, Dataset, random_split
 import pandas as pd
 import numpy as np
 import rootutils
 
-rootutils.setup_root(__file__, indicator=".project-root", pythonpath=True)
 
-PROJECT_ROOT_DIR = rootutils.find_root(search_from=__file__, indicator=".project-root")
-PROJECT_DATA_DIR = str(PROJECT_ROOT_DIR) + '/data/'
 
+def _project_root() -> str:
+    """The directory of this repo's `.project-root`.
 
-class ContactPoint_Dataset(Dataset):
+    `PROJECT_ROOT` is exported by `rootutils.setup_root` in the entry scripts and inherited by dataloader workers, it
+    is only trusted if it actually marks a project root, so a stale value from another project is ignored.
+    """
+    root = os.environ.get("PROJECT_ROOT")
+    if root and os.path.isfile(os.path.join(root, ".project-root")):
+        return root
+    return str(rootutils.find_root(search_from=__file__, indicator=".project-root"))
+
+
+PROJECT_ROOT_DIR = _project_root()
+# set `VPM_DATA_DIR` to read the training data from somewhere else
+PROJECT_DATA_DIR = os.path.join(os.environ.get("VPM_DATA_DIR") or os.path.join(PROJECT_ROOT_DIR, 'data'), '')
+
+
+def _bin_paths(data_path: str) -> Tuple[str, str]:
+    """Paths of the raw `.bin` copy of a `.npy` file and of its `.shape.json` sidecar."""
+    stem = os.path.splitext(data_path)[0]
+    return stem + '.bin', stem + '.shape.json'
+
+
+def convert_to_bin(data_str: str, dtype: str = 'float32') -> str:
+    """Write a `.npy` file of `PROJECT_DATA_DIR` once more as a raw `.bin` plus a `.shape.json` sidecar.
+
+    `ContactPoint_Dataset` memory-maps the `.bin` directly, skipping the `.npy` header parsing and the cast. The
+    sidecar records the dtype and shape of the `.bin`.
+
+    :param data_str: The name of the `.npy` file, e.g. `"bc_3_trainingData.npy"`.
+    :param dtype: The dtype to store the samples in. Defaults to `"float32"`.
+    :return: The path of the written `.bin` file.
+    """
+    data_path = os.path.join(PROJECT_DATA_DIR, data_str)
+    bin_path, shape_path = _bin_paths(data_path)
+
+    data = np.load(data_path, mmap_mode='r')
+    data.astype(dtype).tofile(bin_path)
+    with open(shape_path, 'w') as f:
+        json.dump({'dtype': np.dtype(dtype).name, 'shape': list(data.shape)}, f)
+    return bin_path
+
+
+def _load_bin(bin_path: str, shape_path: str) -> np.memmap:
+    """Memory-map a `.bin` written by `convert_to_bin()` with the dtype and shape recorded in its sidecar."""
+    with open(shape_path) as f:
+        meta = json.load(f)
+    # sidecars written before the dtype was recorded only hold the shape of a float32 `.bin`
+    if isinstance(meta, list):
+        meta = {'dtype': 'float32', 'shape': meta}
+    return np.memmap(bin_path, dtype=np.dtype(meta['dtype']), mode='c', shape=tuple(meta['shape']))
+
+
+class Batch:
+    """Input and output tensors of a single sample or of a whole batch, kept side by side in one `rows` tensor.
+
+    Unpacks like a pair, `x, y = batch`. Pinning and device moves act on `rows`, so every batch is pinned and copied
+    as one contiguous tensor and only split into `x` and `y` views where it is used.
+    """
+
+    __slots__ = ("rows", "num_outputs")
+
+    def __init__(self, rows: torch.Tensor, num_outputs: int = 3) -> None:
+        self.rows = rows
+        self.num_outputs = num_outputs
+
+    @property
+    def x(self) -> torch.Tensor:
+        return self.rows[..., : -self.num_outputs]
+
+    @property
+    def y(self) -> torch.Tensor:
+        return self.rows[..., -self.num_outputs :]
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        return iter((self.x, self.y))
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        return (self.x, self.y)[idx]
+
+    def pin_memory(self) -> "Batch":
+        """Pin the rows, called by the dataloader when `pin_memory=True`."""
+        return Batch(self.rows.pin_memory(), self.num_outputs)
+
+    def to(self, *args, **kwargs) -> "Batch":
+        """Move or cast the rows with a single `Tensor.to()`."""
+        return Batch(self.rows.to(*args, **kwargs), self.num_outputs)
+
+    def record_stream(self, stream: torch.cuda.Stream) -> None:
+        self.rows.record_stream(stream)
+
+
+class _SlabDataset(Dataset):
+    """Input and output rows held side by side in one tensor, fetched a whole batch at a time."""
+
+    def __init__(self, data_t: torch.Tensor, dtype: torch.dtype = torch.float32, num_outputs: int = 3) -> None:
+        """
+        Args:
+            data_t (torch.Tensor): Rows of input features followed by the `num_outputs` output features.
+            dtype (torch.dtype, optional): Dtype of the returned samples.
+            num_outputs (int, optional): Number of trailing output columns.
+        """
+        self.data_t = data_t
+        self.dtype = dtype
+        self.num_outputs = num_outputs
+
+    @property
+    def input_t(self) -> torch.Tensor:
+        return self.data_t[..., : -self.num_outputs]
+
+    @property
+    def output_t(self) -> torch.Tensor:
+        return self.data_t[..., -self.num_outputs :]
+
+    @property
+    def device(self) -> torch.device:
+        return self.data_t.device
+
+    def to(self, device=None, dtype: Optional[torch.dtype] = None) -> "_SlabDataset":
+        """Move the whole dataset to `device`, e.g. to keep it resident on the GPU, and cast it to `dtype`.
+
+        :param device: The target device. Defaults to the current one.
+        :param dtype: The target dtype. Defaults to the current one.
+        :return: The dataset itself.
+        """
+        device = torch.device(device) if device is not None else self.device
+        if dtype is not None:
+            self.dtype = dtype
+        if device.type == "cuda" and self.device.type == "cpu":
+            # stage through pinned memory so the copy is truly asynchronous
+            self.data_t = self.data_t.to(self.dtype).pin_memory()
+        self.data_t = self.data_t.to(device, self.dtype, non_blocking=True)
+        return self
+
+    def normalize_(self, mean: torch.Tensor, std: torch.Tensor) -> "_SlabDataset":
+        """Standardize the input features in place, once, rather than on every fetched batch.
+
+        :param mean: The per-feature mean to subtract.
+        :param std: The per-feature standard deviation to divide by.
+        :return: The dataset itself.
+        """
+        self.input_t.sub_(mean.to(self.data_t)).div_(std.to(self.data_t))
+        return self
+
+    def take(self, indices, dtype: Optional[torch.dtype] = None) -> "_SlabDataset":
+        """Gather the rows at `indices` into a new slab backed by a contiguous tensor of `dtype`.
+
+        :param indices: The row indices to keep, in the order they should be stored.
+        :param dtype: The dtype of the new slab, cast straight from the stored rows. Defaults to `self.dtype`.
+        :return: The new slab, on the same device.
+        """
+        dtype = dtype or self.dtype
+        indices = torch.as_tensor(indices, device=self.device)
+        return _SlabDataset(self.data_t[indices].to(dtype), dtype, self.num_outputs)
+
+    def __len__(self):
+        return len(self.data_t)
+
+    def __getitem__(self, idx) -> Batch:
+        return Batch(self.data_t[idx].to(self.dtype), self.num_outputs)
+
+    def __getitems__(self, idxs) -> Batch:
+        """Fetch a whole batch with a single gather instead of one `__getitem__` per sample."""
+        idxs = torch.as_tensor(idxs, device=self.device)
+        # one gather for inputs and outputs together, the cast is a no-op on slabs from `take()`
+        return Batch(self.data_t[idxs].to(self.dtype), self.num_outputs)
+
+
+class ContactPoint_Dataset(_SlabDataset):
     """cylinder prism fem dataset."""
 
     def __init__(self,
                  data_str: str = 'bc_3_trainingData.npy',
-                 transform=None):
+                 transform=None,
+                 dtype: Union[str, torch.dtype] = torch.float32):
         """
         Args:
             data_path (string): Path to data samples.
             transform (callable, optional): Optional transform to be applied on a sample.
+            dtype (torch.dtype or string, optional): Dtype of the returned samples, e.g. `bfloat16` to halve the
+                memory and transfer size of every batch.
         """
 
         # self.save_hyperparameters(logger=False)
         # data = np.load(self.hparams.data_path)
-        data_path = PROJECT_DATA_DIR + data_str
-        data = np.load(data_path).astype('float32')
-    
-        self.input = data[:, 0 : -3]
-        self.output = data[:, -3 : len(data[:,])]
+        data_path = os.path.join(PROJECT_DATA_DIR, data_str)
 
-    def __len__(self):
-        return len(self.input)
+        dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
 
-    def __getitem__(self, idx):
-        input_tensor = torch.from_numpy(self.input[idx])
-        output_tensor = torch.from_numpy(self.output[idx])
-        
-               
-        return input_tensor,output_tensor
+        # memory-map the file (copy-on-write, so torch can wrap it) and only page in the rows that are fetched,
+        # prefer the raw copy written by `convert_to_bin()` unless the `.npy` has been regenerated since
+        bin_path, shape_path = _bin_paths(data_path)
+        self.bin_path = None
+        if os.path.exists(bin_path) and os.path.exists(shape_path) and (
+            not os.path.exists(data_path) or os.path.getmtime(shape_path) >= os.path.getmtime(data_path)
+        ):
+            data = _load_bin(bin_path, shape_path)
+            stored = torch.from_numpy(data[:0]).dtype
+            if torch.finfo(dtype).bits <= torch.finfo(stored).bits:
+                self.bin_path = bin_path
+            elif not os.path.exists(data_path):
+                raise ValueError(
+                    f"{bin_path} stores {stored} samples, which cannot provide the requested {dtype}. "
+                    f"Restore the .npy or rewrite the .bin with `convert_to_bin(..., dtype=...)`."
+                )
+            else:
+                # the `.bin` is narrower than the requested dtype, read the full precision `.npy` instead
+                data = np.load(data_path, mmap_mode='c')
+        else:
+            data = np.load(data_path, mmap_mode='c')
+
+        # a tensor view of the file, slicing it needs no numpy round-trip
+        super().__init__(
+            data_t=torch.from_numpy(data),
+            dtype=dtype,
+            num_outputs=3,
+        )
         
         
 if __name__ == "__main__":
     
     data1 = ContactPoint_Dataset()
     
-    train_dataloader = DataLoader(data1, batch_size=64, shuffle=True)
+    train_dataloader = DataLoader(data1, batch_size=64, shuffle=True, collate_fn=lambda batch: batch)
 
     train_features, train_labels = next(iter(train_dataloader))
     
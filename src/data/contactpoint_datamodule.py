@@ -1,10 +1,156 @@
-from typing import Any, Dict, Optional, Tuple
+import functools
+import os
+import queue
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 import torch
 from lightning import LightningDataModule
-from torch.utils.data import DataLoader, Dataset, random_split
+from torch.utils.data import DataLoader, Dataset
 import pandas as pd
 import numpy as np
 
+from src.data.components.contact_point_dataset import Batch
+from src.utils.pylogger import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+# trainer precisions that run the whole model in a single non-default dtype, their inputs can be stored in it right away
+_TRUE_PRECISION_DTYPES = {
+    "bf16-true": torch.bfloat16,
+    "16-true": torch.float16,
+    "64-true": torch.float64,
+}
+
+
+def _collate_batch(batch: Batch) -> Batch:
+    """Pass through a batch that the dataset already gathered in `__getitems__`."""
+    return batch
+
+
+def _pin_worker_to_cores(worker_id: int, cores: List[int]) -> None:
+    """Dataloader `worker_init_fn` that pins each worker to one of `cores`, round-robin."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cores[worker_id % len(cores)]})
+
+
+class _DeviceBatchLoader:
+    """Batch a device-resident split by indexing it directly, shuffling with `torch.randperm` on the device."""
+
+    def __init__(self, dataset: Dataset, batch_size: int, shuffle: bool) -> None:
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self) -> int:
+        # incomplete last batches are dropped, same as `drop_last=True`
+        return len(self.dataset) // self.batch_size
+
+    def __iter__(self) -> Iterator[Batch]:
+        if self.shuffle:
+            permutation = torch.randperm(len(self.dataset), device=self.dataset.device)
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            if self.shuffle:
+                yield self.dataset.__getitems__(permutation[start : start + self.batch_size])
+            else:
+                yield self.dataset[start : start + self.batch_size]
+
+
+class _CUDAPrefetcher:
+    """Wrap a dataloader and copy the next batch to the GPU on a side stream while the current one is in use."""
+
+    def __init__(self, loader: DataLoader, device: torch.device) -> None:
+        self.loader = loader
+        self.device = device
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def _preload(self, iterator: Iterator, stream: torch.cuda.Stream) -> Optional[Batch]:
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return batch.to(self.device, non_blocking=True)
+
+    def __iter__(self) -> Iterator[Batch]:
+        stream = torch.cuda.Stream(device=self.device)
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator, stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # the rows were allocated on the side stream but are consumed on the current one
+            batch.record_stream(current_stream)
+            next_batch = self._preload(iterator, stream)
+            yield batch
+
+
+class DataPrefetcher:
+    """Wrap a dataloader and fetch batches on a background thread, moving them to `device` ahead of use.
+
+    Hides the fetch and copy latency behind the training step even without dataloader workers.
+    """
+
+    _END = object()
+
+    def __init__(self, loader: Iterable[Batch], device: torch.device, queue_size: int = 2) -> None:
+        """
+        :param loader: The dataloader to wrap.
+        :param device: The device to move the batches to.
+        :param queue_size: The number of batches to keep ready. Defaults to `2`.
+        """
+        self.loader = loader
+        self.device = device
+        self.queue_size = queue_size
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    @staticmethod
+    def _put(buffer: queue.Queue, stop: threading.Event, item: Any) -> bool:
+        # poll so that the thread exits once the consumer stops iterating early
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, buffer: queue.Queue, stop: threading.Event) -> None:
+        end = self._END
+        try:
+            for batch in self.loader:
+                batch = batch.to(self.device, non_blocking=True)
+                if not self._put(buffer, stop, batch):
+                    return
+        except BaseException as e:
+            end = e
+        finally:
+            # always hand the consumer a terminal item, otherwise it would block on the queue forever
+            self._put(buffer, stop, end)
+
+    def __iter__(self) -> Iterator[Batch]:
+        buffer = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._run, args=(buffer, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is self._END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
 class ContactPointDataModule(LightningDataModule):
     """
     LightningDataModule for ContactPoint dataset.
@@ -51,16 +197,34 @@ class ContactPointDataModule(LightningDataModule):
                  dataset: Dataset,
                  train_val_test_split_ratio: Tuple[float, float] = (0.5, 0.2), 
                  batch_size: int = 128,
-                 num_workers: int = 4,
-                 pin_memory: bool = False,
+                 num_workers: int = 0,
+                 prefetch_factor: int = 2,
+                 pin_memory: Optional[bool] = None,
+                 preload_to_device: bool = True,
+                 cpu_affinity_cores: Optional[List[int]] = None,
+                 normalize_input: bool = False,
+                 use_data_prefetch: bool = False,
     ) -> None:
         """Initialize a `ContactPointDataModule`.
         
         :param dataset: The dataSet to load. Defaults to `"ContactPoint_Dataset"`.
         :param train_val_test_split_ratio: The train, validation and test split. The third is automatically generated : 1 - 0.5 - 0.2 = 0.3 
         :param batch_size: The batch size. Defaults to `128`.
-        :param num_workers: The number of workers. Defaults to `4`.
-        :param pin_memory: Whether to pin memory. Defaults to `False`.
+        :param num_workers: The number of workers. Defaults to `0`, since the in-memory splits are gathered faster in
+            the main process than worker processes can pickle batches back to it.
+        :param prefetch_factor: The number of batches each worker loads in advance. Defaults to `2`.
+        :param pin_memory: Whether to pin memory. Defaults to `None`, which pins whenever CUDA is available.
+        :param preload_to_device: Whether to keep the whole dataset on the GPU when training on one. Batches are then
+            gathered on the device in the main process, so `num_workers`, `pin_memory` and `use_data_prefetch` are
+            ignored. Defaults to `True`.
+        :param cpu_affinity_cores: CPU cores to pin the dataloader workers to, e.g. the cores on the NUMA node of the GPU
+            as listed by `nvidia-smi topo -m`. Only supported on Linux. Defaults to `None`, leaving scheduling to the OS.
+        :param normalize_input: Whether to standardize the input features with the mean and standard deviation of the
+            train split. The statistics are kept in `input_mean` and `input_std` and saved in checkpoints. Defaults to
+            `False`.
+        :param use_data_prefetch: Whether to fetch batches and move them to the device on a background thread, see
+            `DataPrefetcher`. Has no effect on splits preloaded to a single GPU with `preload_to_device`, which are
+            batched on the GPU already. Defaults to `False`.
         
         """
         super().__init__()
@@ -75,6 +239,13 @@ class ContactPointDataModule(LightningDataModule):
         self.data_val: Optional[Dataset] = None
         self.data_test: Optional[Dataset] = None
 
+        # train, val and test indices into `dataset`, computed once on the first `setup()`
+        self._split_indices: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+        # train split input statistics, only set when `normalize_input` is enabled
+        self.input_mean: Optional[torch.Tensor] = None
+        self.input_std: Optional[torch.Tensor] = None
+
         self.batch_size_per_device = batch_size
 
     def prepare_data(self):
@@ -107,66 +278,140 @@ class ContactPointDataModule(LightningDataModule):
             self.batch_size_per_device = self.hparams.batch_size // self.trainer.world_size
         
         # load and split datasets only if not loaded already
-        if not self.data_train and not self.data_val and not self.data_test:            
+        if self.data_train is None:
             
             dataset = self.dataset
-            
-            train_length = int(self.hparams.train_val_test_split_ratio[0] * len(dataset))
-            val_length = int(self.hparams.train_val_test_split_ratio[1] * len(dataset))
-            test_length = int(len(dataset) - train_length - val_length)
-            
-            self.data_train, self.data_val, self.data_test = random_split(
-                dataset=dataset,
-                lengths= (train_length, val_length, test_length),
-                generator=torch.Generator().manual_seed(42),
-            )
-            
+
+            if self._split_indices is None:
+                train_length = int(self.hparams.train_val_test_split_ratio[0] * len(dataset))
+                val_length = int(self.hparams.train_val_test_split_ratio[1] * len(dataset))
+
+                # the same permutation `random_split(..., generator=torch.Generator().manual_seed(42))` draws, so the
+                # split members match the ones the shipped checkpoints were trained and evaluated on
+                permutation = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(42)).numpy()
+                self._split_indices = tuple(np.split(permutation, [train_length, train_length + val_length]))
+
+            device, dtype = None, None
+            if self.trainer is not None:
+                device = self.trainer.strategy.root_device
+                if not self.hparams.preload_to_device or device.type != "cuda":
+                    device = None
+                # e.g. `trainer.precision=bf16-true` halves the size of every batch
+                dtype = _TRUE_PRECISION_DTYPES.get(str(self.trainer.precision))
+
+            bin_path = getattr(dataset, "bin_path", None)
+            if dtype is not None and bin_path and torch.finfo(dtype).bits > torch.finfo(dataset.data_t.dtype).bits:
+                raise ValueError(
+                    f"Trainer precision {self.trainer.precision} needs {dtype} samples, but {bin_path} stores "
+                    f"{dataset.data_t.dtype}. Rewrite it with `convert_to_bin(..., dtype=...)` or remove it to read "
+                    f"the .npy."
+                )
+
+            # copy every split into its own contiguous slab instead of indexing the full dataset through a `Subset`,
+            # the dataloaders shuffle within the slab anyway. The slabs are gathered straight from the stored rows in
+            # the wider of the dataset and the trainer dtype, so a `64-true` run never passes through float32, and
+            # only cast down to the trainer dtype after the statistics are taken
+            take_dtype = torch.promote_types(dataset.dtype, dtype) if dtype is not None else None
+            self.data_train, self.data_val, self.data_test = [
+                dataset.take(indices, take_dtype) for indices in self._split_indices
+            ]
+
+            if self.hparams.normalize_input:
+                # applied once to the slabs here instead of to every batch, statistics restored by
+                # `load_state_dict()` take precedence over recomputing them
+                if self.input_mean is None:
+                    self.input_std, self.input_mean = torch.std_mean(self.data_train.input_t, dim=0)
+                    self.input_std = self.input_std.clamp_min(1e-8)
+                for split in (self.data_train, self.data_val, self.data_test):
+                    split.normalize_(self.input_mean, self.input_std)
+
+            if device is not None or dtype is not None:
+                for split in (self.data_train, self.data_val, self.data_test):
+                    split.to(device, dtype)
             
             # train_features, train_labels = next(iter(self.data_train))
             # print(f"Input Feature batch shape: {train_features.size()}")
             # print(f"Output Feature batch shape: {train_labels.size()}")
 
-    def train_dataloader(self) -> DataLoader[Any]:
-        """Create and return the train dataloader.
+    def _dataloader(self, dataset: Dataset, shuffle: bool) -> Iterable[Any]:
+        """Create a dataloader that fetches whole batches through the dataset's `__getitems__`.
 
-        :return: The train dataloader.
+        A split that already lives on the GPU of a single-device run skips the dataloader machinery altogether and is
+        batched by a `_DeviceBatchLoader`. Otherwise, with `use_data_prefetch` the dataloader is wrapped in a
+        `DataPrefetcher`, and on a single CUDA device it is wrapped in a `_CUDAPrefetcher`, so the copy of the next
+        batch overlaps with the current step. It is left unwrapped under DDP, where Lightning has to swap in its
+        distributed sampler.
+
+        :param dataset: The dataset split to load.
+        :param shuffle: Whether to shuffle the samples.
+        :return: The dataloader.
         """
-        return DataLoader(
-            dataset=self.data_train,
+        # batches of a device-resident dataset are gathered on the device already, workers and pinning only get in the way
+        on_device = dataset.device.type != "cpu"
+        if on_device and self.trainer is not None and self.trainer.world_size == 1:
+            if self.hparams.use_data_prefetch:
+                log.warning("`use_data_prefetch` is ignored for splits preloaded to the GPU by `preload_to_device`.")
+            return _DeviceBatchLoader(dataset, self.batch_size_per_device, shuffle=shuffle)
+
+        num_workers = 0 if on_device else self.hparams.num_workers
+        pin_memory = self.hparams.pin_memory
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        worker_init_fn = None
+        if self.hparams.cpu_affinity_cores:
+            worker_init_fn = functools.partial(_pin_worker_to_cores, cores=list(self.hparams.cpu_affinity_cores))
+        dataloader = DataLoader(
+            dataset=dataset,
             batch_size=self.batch_size_per_device,
-            num_workers=self.hparams.num_workers,
-            pin_memory=self.hparams.pin_memory,
-            shuffle=True,
+            num_workers=num_workers,
+            pin_memory=False if on_device else pin_memory,
+            # keep workers alive across epochs instead of respawning them every time the loader is iterated
+            persistent_workers=num_workers > 0,
+            prefetch_factor=self.hparams.prefetch_factor if num_workers > 0 else None,
+            worker_init_fn=worker_init_fn,
+            collate_fn=_collate_batch,
+            shuffle=shuffle,
             drop_last=True
         )
 
-    def val_dataloader(self) -> DataLoader[Any]:
+        if self.trainer is not None and self.trainer.world_size == 1:
+            device = self.trainer.strategy.root_device
+            if self.hparams.use_data_prefetch:
+                return DataPrefetcher(dataloader, device)
+            if not on_device and device.type == "cuda":
+                return _CUDAPrefetcher(dataloader, device)
+        return dataloader
+
+    def train_dataloader(self) -> Iterable[Any]:
+        """Create and return the train dataloader.
+
+        :return: The train dataloader.
+        """
+        return self._dataloader(self.data_train, shuffle=True)
+
+    def val_dataloader(self) -> Iterable[Any]:
         """Create and return the validation dataloader.
 
         :return: The validation dataloader.
         """
-        return DataLoader(
-            dataset=self.data_val,
-            batch_size=self.batch_size_per_device,
-            num_workers=self.hparams.num_workers,
-            pin_memory=self.hparams.pin_memory,
-            shuffle=False,
-            drop_last=True
-        )
+        return self._dataloader(self.data_val, shuffle=False)
 
-    def test_dataloader(self) -> DataLoader[Any]:
+    def test_dataloader(self) -> Iterable[Any]:
         """Create and return the test dataloader.
 
         :return: The test dataloader.
         """
-        return DataLoader(
-            dataset=self.data_test,
-            batch_size=self.batch_size_per_device,
-            num_workers=self.hparams.num_workers,
-            pin_memory=self.hparams.pin_memory,
-            shuffle=False,
-            drop_last=True
-        )
+        return self._dataloader(self.data_test, shuffle=False)
+
+    def transfer_batch_to_device(self, batch: Batch, device: torch.device, dataloader_idx: int) -> Batch:
+        """Copy a batch to `device` in one non-blocking copy, so copies from pinned memory overlap with compute.
+
+        :param batch: A batch of data containing the input and output tensors.
+        :param device: The target device.
+        :param dataloader_idx: The index of the dataloader the batch belongs to.
+        :return: The batch on `device`.
+        """
+        return batch.to(device, non_blocking=True)
 
     def teardown(self, stage: Optional[str] = None) -> None:
         """Lightning hook for cleaning up after `trainer.fit()`, `trainer.validate()`,
@@ -182,7 +427,9 @@ class ContactPointDataModule(LightningDataModule):
 
         :return: A dictionary containing the datamodule state that you want to save.
         """
-        return {}
+        if self.input_mean is None:
+            return {}
+        return {"input_mean": self.input_mean.cpu(), "input_std": self.input_std.cpu()}
 
     def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
         """Called when loading a checkpoint. Implement to reload datamodule state given datamodule
@@ -190,7 +437,15 @@ class ContactPointDataModule(LightningDataModule):
 
         :param state_dict: The datamodule state returned by `self.state_dict()`.
         """
-        pass
+        if "input_mean" not in state_dict:
+            return
+        mean, std = state_dict["input_mean"].cpu(), state_dict["input_std"].cpu()
+        if self.data_train is not None and self.input_mean is not None:
+            # the slabs are already standardized with `setup()`'s statistics, re-standardize them with the restored
+            # ones: ((x - m) / s - (m' - m) / s) / (s' / s) == (x - m') / s'
+            for split in (self.data_train, self.data_val, self.data_test):
+                split.normalize_((mean - self.input_mean) / self.input_std, std / self.input_std)
+        self.input_mean, self.input_std = mean, std
     
     
 if __name__ == "__main__":
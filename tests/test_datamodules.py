@@ -1,9 +1,22 @@
+import threading
 from pathlib import Path
+from typing import Iterator
 
+import numpy as np
 import pytest
 import torch
+from lightning import Trainer
+from torch.utils.data import random_split
 
-from src.data.contactpoint_datamodule import ContactPointDataModule
+from src.data.components import contact_point_dataset
+from src.data.components.contact_point_dataset import Batch, ContactPoint_Dataset, convert_to_bin
+from src.data.contactpoint_datamodule import (
+    ContactPointDataModule,
+    DataPrefetcher,
+    _CUDAPrefetcher,
+    _DeviceBatchLoader,
+)
+from tests.helpers.run_if import RunIf
 
 
 @pytest.mark.parametrize("batch_size", [32, 128])
@@ -32,3 +45,323 @@ def test_contactpoint_datamodule(batch_size: int) -> None:
     assert len(y) == batch_size
     assert x.dtype == torch.float32
     assert y.dtype == torch.int64
+
+
+@pytest.mark.parametrize("batch_size", [32, 128])
+def test_contactpoint_datamodule_batches(batch_size: int) -> None:
+    """Tests that `ContactPoint_Dataset.__getitems__` hands whole batches to the dataloaders.
+
+    :param batch_size: Batch size of the data to be loaded by the dataloader.
+    """
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), batch_size=batch_size, num_workers=0)
+    dm.setup()
+
+    for dataloader in (dm.train_dataloader(), dm.val_dataloader(), dm.test_dataloader()):
+        batch = next(iter(dataloader))
+        assert isinstance(batch, Batch)
+        x, y = batch
+        assert x.shape == (batch_size, 18)
+        assert y.shape == (batch_size, 3)
+        assert x.dtype == torch.float32
+        assert y.dtype == torch.float32
+
+
+def test_contactpoint_datamodule_split() -> None:
+    """Tests that the train, val and test splits partition the dataset and survive repeated `setup()` calls."""
+    dataset = ContactPoint_Dataset()
+    dm = ContactPointDataModule(dataset=dataset, num_workers=0)
+
+    dm.setup("fit")
+    data_train, data_val, data_test = dm.data_train, dm.data_val, dm.data_test
+    dm.setup("test")
+    assert dm.data_train is data_train and dm.data_val is data_val and dm.data_test is data_test
+
+    assert len(data_train) == int(0.5 * len(dataset))
+    assert len(data_val) == int(0.2 * len(dataset))
+    assert len(data_train) + len(data_val) + len(data_test) == len(dataset)
+
+    # the members match the seeded `random_split` that the shipped checkpoints were trained on
+    lengths = [len(data_train), len(data_val), len(data_test)]
+    splits = random_split(range(len(dataset)), lengths, generator=torch.Generator().manual_seed(42))
+    for split, indices in zip(splits, dm._split_indices):
+        assert np.array_equal(np.asarray(split.indices), indices)
+
+
+def test_data_prefetcher() -> None:
+    """Tests that `DataPrefetcher` yields every batch of the wrapped dataloader and can be iterated again."""
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), num_workers=0)
+    dm.setup()
+
+    dataloader = dm.val_dataloader()
+    prefetcher = DataPrefetcher(dataloader, torch.device("cpu"))
+    assert len(prefetcher) == len(dataloader)
+
+    for _ in range(2):
+        batches = list(prefetcher)
+        assert len(batches) == len(dataloader)
+        assert all(isinstance(batch, Batch) for batch in batches)
+
+
+def test_data_prefetcher_terminates() -> None:
+    """Tests that `DataPrefetcher` joins its thread when iteration stops early and re-raises errors of the wrapped
+    dataloader, including those that do not derive from `Exception`."""
+
+    class Interrupt(BaseException):
+        pass
+
+    def failing_loader() -> Iterator[Batch]:
+        yield Batch(torch.zeros(4, 21))
+        raise Interrupt
+
+    threads = threading.active_count()
+    for batch in DataPrefetcher([Batch(torch.zeros(4, 21))] * 8, torch.device("cpu")):
+        break
+    assert threading.active_count() == threads
+
+    with pytest.raises(Interrupt):
+        list(DataPrefetcher(failing_loader(), torch.device("cpu")))
+    assert threading.active_count() == threads
+
+
+def test_contactpoint_datamodule_normalize_input() -> None:
+    """Tests that `normalize_input` standardizes every split with the train split statistics and that the statistics
+    survive a state dict round trip."""
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), num_workers=0, normalize_input=True)
+    dm.setup()
+
+    std, mean = torch.std_mean(dm.data_train.input_t, dim=0)
+    assert torch.allclose(mean, torch.zeros_like(mean), atol=1e-4)
+    assert torch.allclose(std, torch.ones_like(std), atol=1e-4)
+
+    raw = ContactPoint_Dataset()
+    for split, indices in zip((dm.data_val, dm.data_test), dm._split_indices[1:]):
+        expected = (raw.take(indices).input_t - dm.input_mean) / dm.input_std
+        assert torch.allclose(split.input_t, expected, atol=1e-5)
+
+    state = dm.state_dict()
+    assert set(state) == {"input_mean", "input_std"}
+
+    # restored before `setup()`, the statistics are not recomputed
+    restored = ContactPointDataModule(dataset=ContactPoint_Dataset(), num_workers=0, normalize_input=True)
+    restored.load_state_dict(state)
+    restored.setup()
+    assert torch.equal(restored.input_mean, dm.input_mean) and torch.equal(restored.input_std, dm.input_std)
+    assert torch.allclose(restored.data_val.input_t, dm.data_val.input_t)
+
+    # restored after `setup()`, as Lightning does when resuming, the splits are re-standardized
+    resumed = ContactPointDataModule(dataset=ContactPoint_Dataset(), num_workers=0, normalize_input=True)
+    resumed.setup()
+    resumed.load_state_dict({"input_mean": state["input_mean"] + 1, "input_std": state["input_std"] * 2})
+    expected = (dm.data_val.input_t * dm.input_std + dm.input_mean - (dm.input_mean + 1)) / (dm.input_std * 2)
+    assert torch.allclose(resumed.data_val.input_t, expected, atol=1e-4)
+
+
+def test_contactpoint_datamodule_true_precision() -> None:
+    """Tests that the splits are stored, and the batches yielded, in the dtype of a `*-true` trainer precision."""
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), batch_size=32, num_workers=0)
+    dm.trainer = Trainer(accelerator="cpu", precision="bf16-true", logger=False)
+    dm.setup()
+
+    for split in (dm.data_train, dm.data_val, dm.data_test):
+        assert split.data_t.dtype == torch.bfloat16
+    for dataloader in (dm.train_dataloader(), dm.val_dataloader()):
+        x, y = next(iter(dataloader))
+        assert x.dtype == y.dtype == torch.bfloat16
+
+
+def test_contactpoint_dataset_dtype() -> None:
+    """Tests that `ContactPoint_Dataset` accepts its dtype by name, as set from the Hydra config."""
+    dataset = ContactPoint_Dataset(dtype="bfloat16")
+    assert dataset.dtype == torch.bfloat16
+
+    x, y = dataset[:4]
+    assert x.dtype == y.dtype == torch.bfloat16
+    x, y = dataset.__getitems__([0, 2, 4])
+    assert x.dtype == y.dtype == torch.bfloat16
+
+
+def test_project_root(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tests that `PROJECT_ROOT` is only used as the project root if it contains a `.project-root` file.
+
+    :param tmp_path: The temporary directory used as `PROJECT_ROOT`.
+    :param monkeypatch: The fixture used to set `PROJECT_ROOT`.
+    """
+    repo_root = str(Path(contact_point_dataset.__file__).parents[3])
+    monkeypatch.setenv("PROJECT_ROOT", str(tmp_path))
+    assert contact_point_dataset._project_root() == repo_root
+
+    (tmp_path / ".project-root").touch()
+    assert contact_point_dataset._project_root() == str(tmp_path)
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_device_batch_loader(shuffle: bool) -> None:
+    """Tests that `_DeviceBatchLoader` covers a split in full batches, in order unless shuffled.
+
+    :param shuffle: Whether to shuffle the samples.
+    """
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), num_workers=0)
+    dm.setup()
+
+    loader = _DeviceBatchLoader(dm.data_val, batch_size=128, shuffle=shuffle)
+    batches = list(loader)
+    assert len(batches) == len(loader) == len(dm.data_val) // 128
+    assert all(isinstance(batch, Batch) and batch.x.shape == (128, 18) for batch in batches)
+
+    x = torch.cat([batch.x for batch in batches])
+    assert torch.equal(x, dm.data_val.input_t[: len(x)]) != shuffle
+
+
+def test_convert_to_bin(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tests that `ContactPoint_Dataset` loads the same samples from a `.bin` written by `convert_to_bin`.
+
+    :param tmp_path: The temporary data directory.
+    :param monkeypatch: The fixture used to point `PROJECT_DATA_DIR` at `tmp_path`.
+    """
+    monkeypatch.setattr(contact_point_dataset, "PROJECT_DATA_DIR", str(tmp_path))
+    np.save(tmp_path / "data.npy", np.random.default_rng(0).random((64, 21)))
+
+    from_npy = ContactPoint_Dataset("data.npy")
+    convert_to_bin("data.npy")
+    assert (tmp_path / "data.bin").exists() and (tmp_path / "data.shape.json").exists()
+    from_bin = ContactPoint_Dataset("data.npy")
+
+    assert from_bin.bin_path == str(tmp_path / "data.bin")
+    assert from_bin.data_t.dtype == torch.float32
+    x_npy, y_npy = from_npy[:]
+    x_bin, y_bin = from_bin[:]
+    assert torch.equal(x_npy, x_bin) and torch.equal(y_npy, y_bin)
+
+    # a float32 `.bin` cannot serve float64 samples, the `.npy` is read instead
+    from_npy64 = ContactPoint_Dataset("data.npy", dtype="float64")
+    assert from_npy64.bin_path is None
+    assert torch.equal(from_npy64.data_t, torch.from_numpy(np.load(tmp_path / "data.npy")))
+
+    convert_to_bin("data.npy", dtype="float64")
+    from_bin64 = ContactPoint_Dataset("data.npy", dtype="float64")
+    assert from_bin64.bin_path is not None and torch.equal(from_bin64.data_t, from_npy64.data_t)
+
+    # without the `.bin` next to the sidecar the `.npy` is read
+    (tmp_path / "data.bin").unlink()
+    assert ContactPoint_Dataset("data.npy").bin_path is None
+
+    # refuse to serve float64 from a float32 `.bin` once the `.npy` is gone
+    convert_to_bin("data.npy")
+    (tmp_path / "data.npy").unlink()
+    with pytest.raises(ValueError):
+        ContactPoint_Dataset("data.npy", dtype="float64")
+
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset("data.npy"), batch_size=8, num_workers=0)
+    dm.trainer = Trainer(accelerator="cpu", precision="64-true", logger=False)
+    with pytest.raises(ValueError):
+        dm.setup()
+
+
+@pytest.mark.parametrize("use_bin", [True, False])
+def test_contactpoint_datamodule_64_true(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, use_bin: bool) -> None:
+    """Tests that a `64-true` trainer gets the float64 samples as stored, even though the dataset is configured with
+    the default float32 dtype.
+
+    :param tmp_path: The temporary data directory.
+    :param monkeypatch: The fixture used to point `PROJECT_DATA_DIR` at `tmp_path`.
+    :param use_bin: Whether to load the samples from a float64 `.bin` instead of the `.npy`.
+    """
+    monkeypatch.setattr(contact_point_dataset, "PROJECT_DATA_DIR", str(tmp_path))
+    data = np.random.default_rng(0).random((64, 21))
+    np.save(tmp_path / "data.npy", data)
+    if use_bin:
+        convert_to_bin("data.npy", dtype="float64")
+
+    dataset = ContactPoint_Dataset("data.npy")
+    assert (dataset.bin_path is not None) == use_bin
+    dm = ContactPointDataModule(dataset=dataset, batch_size=8, num_workers=0)
+    dm.trainer = Trainer(accelerator="cpu", precision="64-true", logger=False)
+    dm.setup()
+
+    assert dm.data_train.data_t.dtype == torch.float64
+    assert torch.equal(dm.data_train.data_t, torch.from_numpy(data[dm._split_indices[0]]))
+
+
+def test_contactpoint_datamodule_contiguous_batches() -> None:
+    """Tests that CPU batches keep inputs and outputs in one contiguous tensor, so they are pinned and copied to the
+    device in a single transfer."""
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), num_workers=0, pin_memory=False)
+    dm.setup()
+
+    batch = next(iter(dm.train_dataloader()))
+    assert batch.rows.is_contiguous()
+    assert batch.x.data_ptr() == batch.rows.data_ptr()
+
+    moved = dm.transfer_batch_to_device(batch, torch.device("cpu"), 0)
+    assert isinstance(moved, Batch) and moved.rows.is_contiguous()
+    assert torch.equal(moved.x, batch.x) and torch.equal(moved.y, batch.y)
+
+
+@RunIf(min_gpus=1)
+def test_slab_dataset_to_cuda() -> None:
+    """Tests that a split moved to the GPU holds the same rows and gathers its batches on the GPU."""
+    dataset = ContactPoint_Dataset()
+    split = dataset.take(np.arange(256))
+    on_cpu = dataset.take(np.arange(256))
+
+    assert split.to("cuda") is split
+    torch.cuda.synchronize()
+    assert split.device.type == "cuda" and split.data_t.dtype == torch.float32
+    assert torch.equal(split.data_t.cpu(), on_cpu.data_t)
+
+    batch = split.__getitems__([3, 1, 4, 1, 5])
+    assert batch.rows.device.type == "cuda"
+    assert batch.x.shape == (5, 18) and batch.y.shape == (5, 3)
+    assert torch.equal(batch.rows.cpu(), on_cpu.__getitems__([3, 1, 4, 1, 5]).rows)
+
+
+@RunIf(min_gpus=1)
+def test_cuda_prefetcher() -> None:
+    """Tests that without `preload_to_device` the batches of a single GPU run are prefetched to the GPU on a side
+    stream, with the same values as the plain CPU dataloader."""
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), batch_size=128, num_workers=0, preload_to_device=False)
+    dm.trainer = Trainer(accelerator="gpu", devices=1, logger=False)
+    dm.setup()
+    cpu_dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), batch_size=128, num_workers=0)
+    cpu_dm.setup()
+
+    dataloader = dm.val_dataloader()
+    assert isinstance(dataloader, _CUDAPrefetcher)
+    assert dm.data_val.device.type == "cpu"
+
+    batches = list(dataloader)
+    expected = list(cpu_dm.val_dataloader())
+    assert len(batches) == len(dataloader) == len(expected)
+    for batch, cpu_batch in zip(batches, expected):
+        assert batch.rows.device.type == "cuda"
+        assert batch.x.shape == (128, 18) and batch.y.shape == (128, 3)
+        assert torch.equal(batch.rows.cpu(), cpu_batch.rows)
+
+
+@RunIf(min_gpus=1)
+def test_device_batch_loader_cuda() -> None:
+    """Tests that with the default `preload_to_device` the splits of a single GPU run stay on the GPU and are batched
+    there, with the same values as the plain CPU dataloader."""
+    dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), batch_size=128, num_workers=0)
+    dm.trainer = Trainer(accelerator="gpu", devices=1, logger=False)
+    dm.setup()
+    cpu_dm = ContactPointDataModule(dataset=ContactPoint_Dataset(), batch_size=128, num_workers=0)
+    cpu_dm.setup()
+
+    for split in (dm.data_train, dm.data_val, dm.data_test):
+        assert split.device.type == "cuda"
+
+    for dataloader, cpu_dataloader in (
+        (dm.train_dataloader(), cpu_dm.train_dataloader()),
+        (dm.val_dataloader(), cpu_dm.val_dataloader()),
+    ):
+        assert isinstance(dataloader, _DeviceBatchLoader)
+        batches = list(dataloader)
+        assert len(batches) == len(dataloader) == len(cpu_dataloader)
+        for batch in batches:
+            assert batch.rows.device.type == "cuda"
+            assert batch.x.shape == (128, 18) and batch.y.shape == (128, 3)
+
+    # the unshuffled val batches match the CPU path one for one
+    for batch, cpu_batch in zip(dm.val_dataloader(), cpu_dm.val_dataloader()):
+        assert torch.equal(batch.rows.cpu(), cpu_batch.rows)